@@ -1,35 +1,79 @@
 import multiprocessing
+import multiprocessing.pool
 from threading import Thread
-from queue import Empty
+from queue import Queue
 import traceback
+from itertools import islice
+import os
 import threading
 
+_SENTINEL = object()  # Pushed to the results Queue to wake any iterator once the Pool goes idle or is stopped.
+
+
+def _cpu_count():
+	""" Get the count of CPUs this process may actually run on. """
+	return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+
+
+def _call_each(fnc, items):
+	"""
+	Run the given function with each item, inside a single worker.
+	Errors are captured and returned alongside the results, so each one can still be handled individually.
+	"""
+	results = []
+	for item in items:
+		try:
+			results.append((True, fnc(item)))
+		except Exception as e:
+			results.append((False, e))
+	return results
+
 
 class PyPool:
-	def __init__(self, limit=0, tags=None, callback=None, error_handler=None, iteration=False):
+	def __init__(
+			self, limit=0, tags=None, callback=None, error_handler=None, iteration=False, use_threads=False,
+			max_workers=None, steal_enabled=True, result_buffer=0, initializer=None, initargs=(), maxtasksperchild=None):
 		"""
 		Create a new Pool, and start the managing threads for it.
 
 		:param limit: If set, this is the maximum allowed subprocess "slots" to use for initial setup.
+					If neither this nor `tags` are provided, one general slot is created for each available CPU.
 		:param tags: If provided, this should be an Object. Each key should be a tag name, and each value its slot count.
 		:param callback: This function will be called with the returned data from each sub-process. Disables iteration.
 		:param error_handler: This function will be called with any Exceptions bubbled up from any sub-process.
 		:param iteration: If True, track all returned values and pass them out via the built-in __iter__ method.
+		:param use_threads: If True, run tasks in a pool of threads instead of sub-processes. Useful for I/O-bound work.
+		:param max_workers: The hard cap on total slots across all tags. The worker pool is created once at this size,
+							so every one of these workers is started up front - even those not yet backed by a slot.
+							Defaults to the initial slot total, plus one additional worker per available CPU as headroom.
+		:param steal_enabled: If True, tasks may borrow idle slots from other tags once their own tag and the general pool
+							are both full. Borrowed slots are returned to their owning tag once the task completes.
+		:param result_buffer: If set, the most results to hold for iteration before result handling pauses for the consumer.
+							While paused, no task completions are handled at all - so with this set,
+							never call `join()` before iterating, or it will wait forever on a full buffer.
+		:param initializer: If provided, each worker will call `initializer(*initargs)` once when it starts.
+		:param initargs: The arguments to provide to the initializer. Tuple.
+		:param maxtasksperchild: If set, each worker process is replaced after completing this many tasks.
+							Not supported when `use_threads` is set.
 		"""
+		if not limit and not tags:
+			limit = _cpu_count()
 		self._tags = {}
-		self._results = multiprocessing.Queue()
+		self._results = Queue(maxsize=result_buffer)
+		self._idle_signalled = False
 		self._iteration = iteration
 		self._cb = callback
-		self._tag_lock = multiprocessing.RLock()
-		self._pending_lock = threading.RLock()
-		self._ingest_lock = threading.RLock()
+		self._drop_results = callback is None and not iteration
+		self._use_threads = use_threads
+		self._steal_enabled = steal_enabled
+		self._tag_lock = threading.RLock()
+		self._slot_cv = threading.Condition(self._tag_lock)
 		self._stop = threading.Event()
 		self._total = 0
 		self._pool = None
-		self._pending = []
-		self._thread = Thread(target=self._monitor, daemon=True)
-		self._error_handler = error_handler if error_handler else lambda err: traceback.print_exc()
-		self._ingest_streams = []
+		self._pending = 0
+		self._error_handler = error_handler if error_handler else self._print_error
+		self._ingest_count = 0
 
 		tot = 0
 		if tags:
@@ -42,69 +86,186 @@ class PyPool:
 				self._set(None, limit - tot)
 		else:
 			self._set(None, limit)
-		self._recount_total()
-		self._thread.start()
+		assert self._total > 0, 'Invalid quantity of threads provided!'
+		self._max_workers = max_workers or self._total + _cpu_count()
+		assert self._total <= self._max_workers, 'Initial slot count exceeds max_workers!'
+		if self._use_threads:
+			assert not maxtasksperchild, 'Thread Pools do not support maxtasksperchild!'
+			self._pool = multiprocessing.pool.ThreadPool(self._max_workers, initializer, initargs)
+		else:
+			self._pool = multiprocessing.Pool(self._max_workers, initializer, initargs, maxtasksperchild)
 
 	def _set(self, tag, limit):
-		self._tags[tag] = {
-			'limit': limit,
-			'sem': multiprocessing.Semaphore(limit)
-		}
-
-	def _recount_total(self):
-		with self._tag_lock:
-			self._total = sum(self._tags[k]['limit'] for k in self._tags.keys())
-			assert self._total > 0, 'Invalid quantity of threads provided!'
-			self._pool = multiprocessing.Pool(self._total)
-
-	def _sem(self, tag):
-		if tag not in self._tags or not self._tags[tag]['limit']:
-			return None
-		return self._tags[tag]['sem']
-
-	def _monitor(self):
+		# Update existing tag data in place, as running tasks hold references to it for releasing their slots.
+		tag_rec = self._tags.setdefault(tag, {
+			'limit': 0,
+			'free': 0
+		})
+		self._total += limit - tag_rec['limit']
+		tag_rec['free'] += limit - tag_rec['limit']
+		tag_rec['limit'] = limit
+
+	def _acquire(self, tag, count=1):
+		"""
+		Block until at least one slot is free for the given tag (or the general pool), then claim up to `count` slots.
 
-		def check(r):
-			# noinspection PyBroadException
-			try:
-				r['res'].successful()  # Throws if not completed, otherwise ignore and indicate it has resolved.
-				return True
-			except Exception:
-				return False
-		while not self._stop.is_set():
-			self._stop.wait(.01)
-			with self._pending_lock:
-				finished = filter(check, self._pending)
-				for f in finished:
-					try:
-						val = f['res'].get()
-						self._finish(val, f['tag'], f['callback'])
-					except Exception as e:
-						if f['error']:
-							f['error'](e)
-						elif self._error_handler:
-							self._error_handler(e)
-						else:
-							raise Exception('Unhandled exception from process call! Use on_error() to set a handler!')
-					finally:
-						self._pending.remove(f)
-
-	def _finish(self, res, tag, callback):
-		self._sem(tag).release()  # Release one of the Semaphore for this tag.
-		if self._stop.is_set():
+		:return: A list with the tag data each claimed slot was taken from, or an empty list if the Pool was stopped.
+		"""
+		used = []
+		tags = self._tags
+		with self._slot_cv:
+			while not used:
+				if self._stop.is_set():
+					return used
+				slots = [rec for rec in (tags.get(tag), tags.get(None)) if rec and rec['limit']]
+				if not slots:
+					raise KeyError('No valid pool could be found for the given tag: %s' % tag)
+				self._claim(slots, count, used)
+				if not used and self._steal_enabled:
+					self._claim([rec for t, rec in tags.items() if t != tag and t is not None], count, used)
+				if not used:
+					self._slot_cv.wait()
+		return used
+
+	def _claim(self, slots, count, used):
+		for tag_rec in slots:
+			while len(used) < count and tag_rec['free'] > 0:
+				tag_rec['free'] -= 1
+				used.append(tag_rec)
+
+	def _release(self, *tag_recs):
+		with self._slot_cv:
+			for tag_rec in tag_recs:
+				tag_rec['free'] += 1
+			self._slot_cv.notify_all()  # Waiters may be blocked on different tags, so wake them all to re-check.
+
+	def _on_ok(self, res, tag_rec, callback, error):
+		# Runs in the Pool's result handler thread, so nothing here may be allowed to raise.
+		self._release(tag_rec)  # Release the slot this task was running in.
+		try:
+			self._dispatch(res, callback, error)
+		finally:
+			self._done()
+
+	def _on_err(self, err, tag_rec, error):
+		self._release(tag_rec)
+		try:
+			self._handle_error(err, error)
+		finally:
+			self._done()
+
+	def _on_batch_ok(self, results, tag_recs, callback, error):
+		self._release(*tag_recs)
+		try:
+			for res in results:
+				self._dispatch(res, callback, error)
+		finally:
+			self._done(len(tag_recs))
+
+	def _on_batch_err(self, err, tag_recs, error):
+		self._release(*tag_recs)
+		try:
+			self._handle_error(err, error)
+		finally:
+			self._done(len(tag_recs))
+
+	def _on_chunk_ok(self, results, tag_rec, callback, error):
+		self._release(tag_rec)
+		try:
+			for ok, res in results:
+				if ok:
+					self._dispatch(res, callback, error)
+				else:
+					self._handle_error(res, error)
+		finally:
+			self._done(len(results))
+
+	def _on_chunk_err(self, err, tag_rec, count, error):
+		self._release(tag_rec)
+		try:
+			self._handle_error(err, error)
+		finally:
+			self._done(count)
+
+	def _dispatch(self, res, callback, error):
+		try:
+			if self._stop.is_set():
+				return
+			if callback:
+				callback(res)
+			elif not self._drop_results:
+				if self._cb:
+					self._cb(res)
+				else:
+					self._results.put(res)
+		except Exception as e:
+			self._handle_error(e, error)
+
+	@staticmethod
+	def _print_error(err):
+		traceback.print_exception(type(err), err, err.__traceback__)
+
+	def _handle_error(self, err, error):
+		# noinspection PyBroadException
+		try:
+			if error:
+				error(err)
+			elif self._error_handler:
+				self._error_handler(err)
+			else:
+				raise Exception('Unhandled exception from process call! Use on_error() to set a handler!') from err
+		except Exception:
+			traceback.print_exc()
+
+	def _done(self, count=1):
+		with self._slot_cv:
+			self._pending -= count
+			if self._idle():
+				self._slot_cv.notify_all()
+		self._signal_idle()
+
+	def _signal_idle(self):
+		if not self._iteration or self._stop.is_set() or not self._idle():
 			return
-		if callback:
-			callback(res)
-		elif self._cb:
-			self._cb(res)
-		elif self._iteration:
-			self._results.put(res)
-
-	def _run(self, tag, fnc, args, callback=None, error=None):
-		res = self._pool.apply_async(fnc, args=args)  # This method supports a callback, but it doesn't run on error.
-		with self._pending_lock:
-			self._pending.append({'tag': tag, 'res': res, 'callback': callback, 'error': error})
-		return res
+		with self._slot_cv:
+			if self._idle_signalled:
+				return
+			self._idle_signalled = True
+		self._results.put(_SENTINEL)  # Must block if the buffer is full, or the iterator would never wake. See `stop()`.
+
+	def _idle(self):
+		with self._slot_cv:
+			return not self._pending and not self._ingest_count
+
+	def _run(self, tag_rec, fnc, args, callback=None, error=None):
+		with self._slot_cv:
+			self._pending += 1
+		return self._pool.apply_async(
+			fnc,
+			args=args,
+			callback=lambda r: self._on_ok(r, tag_rec, callback, error),
+			error_callback=lambda e: self._on_err(e, tag_rec, error)
+		)
+
+	def _run_batch(self, tag_recs, fnc, items, args, callback=None, error=None):
+		with self._slot_cv:
+			self._pending += len(tag_recs)
+		return self._pool.starmap_async(
+			fnc,
+			[(e,) + args for e in items],
+			callback=lambda r: self._on_batch_ok(r, tag_recs, callback, error),
+			error_callback=lambda e: self._on_batch_err(e, tag_recs, error)
+		)
+
+	def _run_chunk(self, tag_rec, fnc, items, callback=None, error=None):
+		with self._slot_cv:
+			self._pending += len(items)
+		return self._pool.apply_async(
+			_call_each,
+			args=(fnc, items),
+			callback=lambda r: self._on_chunk_ok(r, tag_rec, callback, error),
+			error_callback=lambda e: self._on_chunk_err(e, tag_rec, len(items), error)
+		)
 
 	def iter(self):
 		"""
@@ -115,23 +276,20 @@ class PyPool:
 		"""
 		if not self._iteration:
 			raise Exception('Iteration is disabled on this Pool!')
-		brk = False
 		while not self._stop.is_set():
 			if self._cb:
 				raise Exception('Error: Cannot iterate while callback is activated on pool!')
-			try:
-				yield self._results.get(block=True, timeout=.1)
-				brk = False
-			except Empty:
-				if self._stop.is_set():
+			with self._slot_cv:
+				# Results are queued before their task stops counting as pending, so nothing can still be on its way.
+				if self._idle() and self._results.empty():
 					break
-				with self._pending_lock:
-					if not len(self._pending):
-						with self._ingest_lock:
-							if not len(self._ingest_streams):
-								if brk:
-									break
-								brk = True
+			res = self._results.get()
+			if res is _SENTINEL:
+				# May be left over from an earlier idle period, with results queued behind it - so just re-check.
+				with self._slot_cv:
+					self._idle_signalled = False
+				continue
+			yield res
 
 	def put(self, tag, fnc, args=tuple(), callback=None, error=None):
 		"""
@@ -146,16 +304,12 @@ class PyPool:
 		:param error: If provided, use this function as the callback to handle errors from the subprocess.
 		:return: a `multiprocessing.pool.AsyncResult` instance, in case you have use for it.
 		"""
-		sems = [self._sem(tag), self._sem(None)]
-		args = tuple(args)
-		while any(sems) and not self._stop.is_set():
-			for sem in sems:
-				if not sem:
-					continue
-				if sem.acquire(block=True, timeout=0.05):
-					return self._run(tag, fnc, args, callback, error)
-		if not self._stop.is_set():
-			raise KeyError('No valid pool could be found for the given tag: %s' % tag)
+		if not isinstance(args, tuple):
+			args = tuple(args)
+		used = self._acquire(tag)
+		if not used:
+			return None
+		return self._run(used[0], fnc, args, callback, error)
 
 	@property
 	def pending(self):
@@ -164,42 +318,76 @@ class PyPool:
 
 		:return: An estimated count of the running sub-processes.
 		"""
-		with self._pending_lock:
-			return len(self._pending)
+		with self._slot_cv:
+			return self._pending
+
+	@property
+	def pending_ingestors(self):
+		"""
+		Get a count of the Ingestor threads that are still submitting values to this Pool.
+
+		:return: The count of running Ingestor threads.
+		"""
+		with self._slot_cv:
+			return self._ingest_count
 
 	def adjust(self, tag, new_limit, use_general_slots=False):
 		"""
 		Change the total limit of the given tag.
 		This method will block until enough slots can be freed/removed to match the new value.
+		The total slots across all tags may never exceed the `max_workers` this Pool was created with.
 
 		:param tag: The tag to change.
 		:param new_limit: The new limit for this tag.
 		:param use_general_slots: If True, each freed/allocated thread slot will be moved to/from the general pool.
 		"""
 		new_limit = max(0, new_limit)
-		with self._tag_lock:
+		with self._slot_cv:
 			dat = self._tags[tag] if tag in self._tags else None
+			current = dat['limit'] if dat else 0
+			if not use_general_slots or not dat:  # Slots are being created or destroyed, rather than moved.
+				assert self._total - current + new_limit > 0, 'Invalid quantity of threads provided!'
+				if self._total - current + new_limit > self._max_workers:
+					raise ValueError('Adjusting tag %s to %s slots would exceed max_workers (%s).' % (tag, new_limit, self._max_workers))
 			if use_general_slots and None not in self._tags:
 				self._set(None, 0)
 			if not dat:
 				self._set(tag, new_limit)
 			else:
-				while dat['limit'] < new_limit:
-					dat['sem'].release()
-					dat['limit'] += 1
-					if use_general_slots:
-						if self._tags[None]['limit'] > 0:
-							self._tags[None]['sem'].acquire()
-							self._tags[None]['limit'] -= 1
-						else:
-							raise IndexError('Unable to move the correct amount of slots from the General Pool.')
-				while dat['limit'] > new_limit:
-					dat['sem'].acquire()
-					dat['limit'] -= 1
-					if use_general_slots:
-						self._tags[None]['sem'].release()
-						self._tags[None]['limit'] += 1
-			self._recount_total()
+				general = self._tags.get(None) if use_general_slots else None
+				delta = new_limit - dat['limit']
+				if delta > 0 and general is None:
+					dat['free'] += delta
+					dat['limit'] += delta
+					self._total += delta
+				elif delta > 0:
+					if general['limit'] < delta:
+						raise IndexError('Unable to move the correct amount of slots from the General Pool.')
+					self._move_slots(general, dat, delta)
+				elif delta < 0:
+					self._move_slots(dat, general, -delta)
+				self._slot_cv.notify_all()
+
+	def _move_slots(self, src, dst, count):
+		"""
+		Move `count` slots from the `src` tag data to `dst`, or destroy them if `dst` is None.
+		Slots are moved in as few steps as possible, blocking as needed until enough of them are free in `src`.
+		"""
+		with self._slot_cv:
+			while count > 0:
+				self._slot_cv.wait_for(lambda: src['free'] > 0 or self._stop.is_set())
+				if self._stop.is_set():
+					return
+				moved = min(src['free'], count)
+				src['free'] -= moved
+				src['limit'] -= moved
+				if dst is None:
+					self._total -= moved
+				else:
+					dst['free'] += moved
+					dst['limit'] += moved
+				count -= moved
+				self._slot_cv.notify_all()
 
 	def callback(self, cb):
 		"""
@@ -209,6 +397,7 @@ class PyPool:
 		:param cb: A function, which accepts one parameter - the returned data. EG: `lambda data: print('Result:', data)`.
 		"""
 		self._cb = cb
+		self._drop_results = cb is None and not self._iteration
 
 	def on_error(self, error_handler):
 		"""
@@ -223,19 +412,37 @@ class PyPool:
 		"""
 		Cleanly shut down this Pool. While everything here should shut down on its own when the main thread exits,
 		this method can be used instead to kill the Pool at-will.
+		This is also called automatically when the Pool is used as a context manager and the `with` block exits.
 		
 		Calling this is destructive, and will immediately interrupt any active ingestor threads -
 		as well as any result handling.
 		Use the `join()` method before calling this if you want to wait for all processing to properly finish first.
 		"""
 		self._stop.set()
-
-	def ingest(self, iterable, tag, fnc, args=(), callback=None, error=None):
+		with self._slot_cv:
+			self._slot_cv.notify_all()
+		with self._results.mutex:
+			# Discard unread results and unbound the buffer, so nothing blocked on a full buffer can stay that way.
+			# Otherwise terminating the Pool would wait forever on its result handler thread.
+			# Puts already waiting re-check against maxsize, and a maxsize of 0 would never let them through.
+			self._results.queue.clear()
+			self._results.maxsize = float('inf')
+			self._results.not_full.notify_all()
+		self._results.put(_SENTINEL)
+		self._pool.terminate()  # Reclaims the worker processes, their pipes, and the Pool's handler threads.
+
+	def ingest(self, iterable, tag, fnc, args=(), callback=None, error=None, batch_size=1):
 		"""
 		Non-blocking convenience method - this Iterates through the given Iterable, 
 		and calls `self.put()` with each element.
 		Each element in the iterable will be passed as the first parameter to the given function.
 
+		If `batch_size` is larger than 1, elements are instead buffered and submitted in groups of up to `batch_size`,
+		claiming as many free slots as possible at once. This reduces overhead for very short tasks.
+		Each element still needs its own slot, so a batch never grows larger than the slots free when it is submitted.
+		Every slot in a batch is held until the whole batch completes, so one slow element delays the rest.
+		Note that a failing element will report a single error for its whole batch, and discard the batch's results.
+
 		This will launch a new Daemon thread, which will run in the background.
 		You may start multiple Ingestor Threads to run concurrently, and await them all using the Pool's `join()` method.
 
@@ -245,32 +452,95 @@ class PyPool:
 		:param args: The arguments to provide to this function. Each item in the iterable will be prepended to these.
 		:param callback: If provided, use this function as the callback for each result.
 		:param error: If provided, use this function as the callback to handle each error from the subprocesses.
+		:param batch_size: The maximum amount of elements to submit together.
 		:return: The Thread, already started, which handles adding the given values.
 		"""
-		_t = None
+		if not isinstance(args, tuple):
+			args = tuple(args)
 
 		def ing():
-			for e in iterable:
-				if self._stop.is_set():
+			if batch_size > 1:
+				self._ingest_chunks(
+					iterable, tag, batch_size, lambda used, items: self._run_batch(used, fnc, items, args, callback, error)
+				)
+			else:
+				for e in iterable:
+					if self._stop.is_set():
+						break
+					self.put(tag, fnc, (e,) + args, callback, error)
+		return self._start_ingestor(ing)
+
+	def ingest_stream(self, iterable, tag, fnc, chunksize=64, callback=None, error=None):
+		"""
+		Non-blocking alternative to `ingest()`, which streams the given Iterable through the Pool in chunks.
+		Each element in the iterable will be passed as the only parameter to the given function.
+
+		Every chunk of up to `chunksize` elements is sent to a single worker as one task, and uses a single slot.
+		This greatly reduces overhead for very short tasks, but larger chunks also mean fewer of them to run in parallel.
+		Unlike a batched `ingest()`, each result (or error) is still handled individually once its chunk returns.
+
+		This will launch a new Daemon thread, which will run in the background.
+		It is tracked alongside the other Ingestor Threads, and can be awaited using the Pool's `join()` method.
+
+		:param iterable: The input, must be any iterable.
+		:param tag: The "group" this subprocess should run as. Used for limiting concurrent count based off tags.
+		:param fnc: The function to run.
+		:param chunksize: The maximum amount of elements to run together in one worker. Must be at least 1.
+		:param callback: If provided, use this function as the callback for each result.
+		:param error: If provided, use this function as the callback to handle each error from the subprocesses.
+		:return: The Thread, already started, which handles adding the given values.
+		"""
+		if chunksize < 1:
+			raise ValueError('Invalid chunksize provided: %s' % chunksize)
+
+		def stream():
+			it = iter(iterable)
+			while not self._stop.is_set():
+				items = list(islice(it, chunksize))
+				if not items:
+					break
+				used = self._acquire(tag)
+				if not used:
 					break
-				self.put(tag, fnc, (e, *args), callback, error)
-			with self._ingest_lock:
-				self._ingest_streams.remove(_t)
+				self._run_chunk(used[0], fnc, items, callback, error)
+		return self._start_ingestor(stream)
+
+	def _start_ingestor(self, target):
+		def ing():
+			try:
+				target()
+			finally:
+				with self._slot_cv:
+					self._ingest_count -= 1
+					self._slot_cv.notify_all()
+				self._signal_idle()
 		_t = Thread(daemon=True, target=ing)
-		with self._ingest_lock:
-			self._ingest_streams.append(_t)
+		with self._slot_cv:
+			self._ingest_count += 1
 		_t.start()
 		return _t
 
+	def _ingest_chunks(self, iterable, tag, size, submit):
+		it = iter(iterable)
+		buffer = []
+		while not self._stop.is_set():
+			buffer.extend(islice(it, size - len(buffer)))
+			if not buffer:
+				break
+			used = self._acquire(tag, len(buffer))
+			if not used:
+				break
+			submit(used, buffer[:len(used)])
+			buffer = buffer[len(used):]
+
 	def join(self):
 		"""
 		Awaits all running Ingestor threads, as well as any pending processes.
+		If this Pool has a `result_buffer`, iterate the results instead - the buffer filling up would block this forever.
 		:return:
 		"""
-		for th in self._ingest_streams:
-			th.join()
-		while self.pending:
-			self._stop.wait(0.1)
+		with self._slot_cv:
+			self._slot_cv.wait_for(lambda: self._stop.is_set() or self._idle())
 
 	def get_tags(self):
 		"""
@@ -283,5 +553,11 @@ class PyPool:
 	def __iter__(self):
 		return self.iter()
 
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.stop()
+
 	def __repr__(self):
 		return '''<TagPool: %s || Total: %s>''' % (self._tags, self._total)
@@ -9,12 +9,15 @@ class TestPool(unittest.TestCase):
 
 	def setUp(self):
 		# Create an example Pool, using a callback to print returned data & no error handling.
-		self.pool = PyPool(iteration=True, tags={
+		self.pool = PyPool(iteration=True, max_workers=12, tags={
 			'test': 1,
 			'ignore': 1
 		}, callback=lambda r: print('Returned:', r, ', Pending:', self.pool.pending))
 		self.count = 0
 
+	def tearDown(self):
+		self.pool.stop()
+
 	def test_async(self):
 		""" Concurrency should properly work """
 		start = time.time()
@@ -50,6 +53,25 @@ class TestPool(unittest.TestCase):
 		with self.assertRaises(Exception, msg='Failed to raise Error on invalid pool size increase!'):
 			pool.adjust('test', 11, use_general_slots=True)
 
+	def test_adjust_while_running(self):
+		""" Removing a tag's slots while in use should wait for them, without losing any slots """
+		pool = self.pool
+		pool.callback(None)
+		pool.adjust(None, 0)
+		pool.put('test', time.sleep, [1])
+		pool.adjust('test', 0, use_general_slots=True)  # Blocks until the running task frees its slot.
+		self.assertEqual(pool.get_tags(), {'test': 0, 'ignore': 1, None: 1}, 'Slots were not moved correctly!')
+		pool.put('test', fnc, [1])
+		pool.join()
+		self.assertEqual(pool._tags[None]['free'], 1, 'Released slot was lost after adjusting its tag!')
+		self.assertEqual(pool._tags['test']['free'], 0, 'Released slot was returned to the emptied tag!')
+
+	def test_max_workers(self):
+		""" Adjust should refuse to grow the Pool beyond max_workers """
+		with self.assertRaises(ValueError, msg='Failed to raise Error when exceeding max_workers!'):
+			self.pool.adjust('test', 12)
+		self.assertEqual(self.pool.get_tags()['test'], 1, 'Rejected adjustment should not change the tag!')
+
 	def test_stop(self):
 		""" Stop should correctly exit """
 		start = time.time()
@@ -64,6 +86,33 @@ class TestPool(unittest.TestCase):
 
 		self.assertLess(time.time() - start, 15, 'Took longer than expected to run test - concurrency may be broken')
 
+	def test_stop_wakes_iterator(self):
+		""" Stop should immediately wake a blocked iterator """
+		self.pool.callback(None)
+		self.pool.ingest([60], 'test', time.sleep, [])
+		threading.Timer(0.5, self.pool.stop).start()
+		start = time.time()
+		self.assertEqual(list(self.pool), [], 'Iterator returned values after stop!')
+		self.assertLess(time.time() - start, 5, 'Iterator was not woken by stop!')
+
+	def test_context_manager(self):
+		""" Exiting a with block should stop the Pool and its workers """
+		with PyPool(tags={'test': 2}, iteration=True) as pool:
+			pool.ingest([1, 2, 3], 'test', fnc)
+			self.assertEqual(sum(pool), 6, 'Did not get all results back inside with block!')
+		self.assertTrue(pool._stop.is_set(), 'Pool was not stopped on exit!')
+
+	def test_stop_full_buffer(self):
+		""" Stop should not hang while a full result buffer is blocking result handling """
+		pool = PyPool(tags={'test': 3}, iteration=True, use_threads=True, result_buffer=1)
+		pool.ingest(range(3), 'test', fnc)
+		next(iter(pool))  # Read one result, then stop reading with the buffer full and results still incoming.
+		time.sleep(0.5)
+		stopper = threading.Thread(target=pool.stop, daemon=True)
+		stopper.start()
+		stopper.join(5)
+		self.assertFalse(stopper.is_alive(), 'Stop hung on a full result buffer!')
+
 	def test_iter(self):
 		""" The iterator should work """
 		self.pool.ingest([1, 2, 3, 4, 5, 6, 7, 8], 'test', fnc)
@@ -73,6 +122,103 @@ class TestPool(unittest.TestCase):
 			count += r
 		self.assertEqual(count, 36, 'Did not get all results back from iterator!')
 
+	def test_iter_after_idle(self):
+		""" Results queued after the Pool went idle, without anyone iterating, should not be lost """
+		self.pool.callback(None)
+		self.pool.put('test', fnc, [1])
+		self.pool.join()
+		self.pool.put('test', fnc, [2])
+		self.pool.join()
+		self.assertEqual(sorted(self.pool), [1, 2], 'Results queued behind an idle signal were lost!')
+		self.assertEqual(list(self.pool), [], 'Iterating an idle Pool should return immediately!')
+
+	def test_batch_ingest(self):
+		""" Batched ingestion should return every result """
+		self.pool.adjust('test', 4)
+		self.pool.ingest(range(100), 'test', fnc, batch_size=10)
+		self.pool.callback(None)
+		self.assertEqual(sum(self.pool), 4950, 'Did not get all results back from batched ingest!')
+
+	def test_ingest_stream(self):
+		""" Streamed ingestion should handle each result and error individually """
+		def cb(val):
+			self.count += val
+
+		def err(e):
+			self.count += 100
+
+		self.pool.adjust('test', 4)
+		self.pool.ingest_stream([1, 2, 3, 'bad', 4], 'test', double, chunksize=3, callback=cb, error=err)
+		self.pool.join()
+		self.assertEqual(self.count, 120, 'Streamed results/errors were not all handled!')
+
+		with self.assertRaises(ValueError, msg='Failed to reject an empty chunksize!'):
+			self.pool.ingest_stream([1], 'test', double, chunksize=0)
+
+	def test_ingest_stream_slow_head(self):
+		""" A slow element should not hold up the slots of the rest of the stream """
+		with PyPool(tags={'test': 4}, iteration=True, use_threads=True) as pool:
+			start = time.time()
+			pool.ingest_stream([2] + [0.05] * 120, 'test', time.sleep, chunksize=2)
+			self.assertEqual(len(list(pool)), 121, 'Did not get all results back from the stream!')
+			self.assertLess(time.time() - start, 3, 'Slow element held up the rest of the stream!')
+
+	def test_ingest_stream_stop(self):
+		""" Stopping mid-stream should not leave any threads behind """
+		before = threading.active_count()
+		with PyPool(tags={'test': 2}, iteration=True) as pool:
+			pool.ingest_stream([60] * 10, 'test', time.sleep, chunksize=2)
+			time.sleep(0.5)
+		time.sleep(0.5)
+		self.assertEqual(threading.active_count(), before, 'Stopped stream left threads running!')
+
+	def test_steal(self):
+		""" Saturated tags should borrow idle slots from other tags, and return them afterwards """
+		self.pool.adjust('ignore', 5)
+		self.pool.adjust(None, 0)
+		start = time.time()
+		self.pool.ingest([1, 1, 1, 1, 1, 1], 'test', time.sleep, [])
+		self.pool.join()
+		self.assertLess(time.time() - start, 4, 'Tag did not borrow idle slots from other tags!')
+		self.assertEqual(self.pool._tags['ignore']['free'], 5, 'Borrowed slots were not returned to their tag!')
+
+	def test_no_steal(self):
+		""" With stealing disabled, a saturated tag should never take another tag's reserved slots """
+		with PyPool(tags={'test': 1, 'ignore': 3}, use_threads=True, steal_enabled=False) as pool:
+			pool.ingest([0.5, 0.5, 0.5], 'test', time.sleep, [])
+			time.sleep(0.2)
+			self.assertEqual(pool._tags['ignore']['free'], 3, 'Reserved slots were borrowed by another tag!')
+			self.assertEqual(pool.pending, 1, 'Saturated tag ran more tasks than it has slots!')
+			pool.join()
+
+	def test_result_buffer(self):
+		""" A bounded result buffer should still deliver every result to the iterator """
+		with PyPool(tags={'test': 2}, iteration=True, use_threads=True, result_buffer=2) as pool:
+			pool.ingest(range(20), 'test', fnc)
+			self.assertEqual(sum(pool), 190, 'Did not get all results back through the bounded buffer!')
+
+	def test_result_buffer_early_exit(self):
+		""" Leaving a with block mid-iteration should stop the Pool, even with a full result buffer """
+		start = time.time()
+		with PyPool(tags={'test': 3}, iteration=True, use_threads=True, result_buffer=1) as pool:
+			pool.ingest(range(20), 'test', fnc)
+			for _ in pool:
+				break
+		self.assertTrue(pool._stop.is_set(), 'Pool was not stopped on exit!')
+		self.assertLess(time.time() - start, 5, 'Exiting with a full result buffer took too long!')
+
+	def test_initializer(self):
+		""" Each worker should run the initializer before any tasks """
+		with PyPool(tags={'test': 2}, iteration=True, initializer=init_worker, initargs=(5,), maxtasksperchild=2) as pool:
+			pool.ingest(range(4), 'test', worker_value)
+			self.assertEqual(sum(pool), 26, 'Workers were not initialized before running tasks!')
+
+	def test_default_limit(self):
+		""" A Pool created without limits should default to the available CPUs """
+		cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+		with PyPool() as pool:
+			self.assertEqual(pool.get_tags(), {None: cpus}, 'Default slots did not match the available CPUs!')
+
 	def test_callback(self):
 		""" The callback method should work """
 		def cb(val):
@@ -111,11 +257,35 @@ class TestPool(unittest.TestCase):
 
 		self.assertEqual(self.count, 103, 'Custom callback/error was not triggered enough times!')
 
+	def test_threads(self):
+		""" Thread-backed Pools should run tasks and return results """
+		with PyPool(tags={'test': 2}, iteration=True, use_threads=True) as pool:
+			pool.ingest([1, 2, 3, 4], 'test', fnc)
+			self.assertEqual(sum(pool), 10, 'Did not get all results back from threaded pool!')
+
 
 def fnc(num):
 	return num
 
 
+_worker_value = 0
+
+
+def init_worker(val):
+	global _worker_value
+	_worker_value = val
+
+
+def worker_value(num):
+	return num + _worker_value
+
+
+def double(num):
+	if not isinstance(num, int):
+		raise ValueError('Invalid number: %s' % num)
+	return num * 2
+
+
 def timeout():
 	time.sleep(60)
 	print('Timed out!')